@@ -21,6 +21,9 @@ setup(
     package="src/certbot_dns_dreamhost",
     include_package_data=True,
     install_requires=install_requires,
+    extras_require={
+        "orjson": ["orjson"],
+    },
     entry_points={
         "certbot.plugins": [
             "dns-dreamhost = certbot_dns_dreamhost.dns_dreamhost:Authenticator"
@@ -5,14 +5,54 @@ Last Update: 23-11-2022
 """
 
 import logging
-from typing import Callable
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from acme import challenges
+from certbot import achallenges
 from certbot import errors
+from certbot.display import util as display_util
 from certbot.plugins import dns_common
 
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
+
 logger = logging.getLogger(__name__)
 
+# upper bound on concurrent requests to the DreamHost API, to stay clear of rate limits
+MAX_WORKERS = 8
+
+# transient responses worth retrying, with exponential backoff and jitter
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_BASE_SECONDS = 1
+RETRY_CAP_SECONDS = 30
+# (connect, read) timeout for a single API request
+REQUEST_TIMEOUT_SECONDS = (10, 60)
+# listing is idempotent; adding/removing is retried less to avoid double writes
+LIST_ATTEMPTS = 5
+WRITE_ATTEMPTS = 2
+# how long an error reported by the API is replayed for an identical request
+NEGATIVE_CACHE_SECONDS = 5
+
+def _achall_domain(achall: achallenges.AnnotatedChallenge) -> str:
+    # certbot 5.3 deprecates achall.domain in favour of achall.identifier,
+    # which the older releases allowed by setup.py do not have
+    identifier = getattr(achall, "identifier", None)
+    if identifier is not None:
+        return identifier.value
+    return achall.domain
+
 class Authenticator(dns_common.DNSAuthenticator):
     """
     DNS Authenticator for DreamHost
@@ -26,6 +66,12 @@ class Authenticator(dns_common.DNSAuthenticator):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self.credentials = None
+        # shared by every client created during this run, so all challenges
+        # reuse the same keep-alive connection
+        self._session = None
+        # one client per set of credentials, shared by _perform and _cleanup
+        self._cached_client = None
+        self._cached_client_lock = threading.Lock()
 
     @classmethod
     def add_parser_arguments(
@@ -52,6 +98,75 @@ class Authenticator(dns_common.DNSAuthenticator):
             },
         )
 
+    def perform(
+        self, achalls: List[achallenges.AnnotatedChallenge]
+    ) -> List[challenges.ChallengeResponse]:
+        self._setup_credentials()
+        self._attempt_cleanup = True
+
+        self._run_grouped(achalls, self._perform)
+
+        expected = [
+            (
+                achall.validation_domain_name(_achall_domain(achall)),
+                achall.validation(achall.account_key),
+            )
+            for achall in achalls
+        ]
+        self._wait_for_records(expected)
+        return [achall.response(achall.account_key) for achall in achalls]
+
+    def _wait_for_records(self, expected: List[Tuple[str, str]]) -> None:
+        propagation_seconds = self.conf("propagation-seconds")
+        # see dns_common.DNSAuthenticator.perform
+        display_util.notify(
+            "Waiting %d seconds for DNS changes to propagate" % propagation_seconds
+        )
+        time.sleep(propagation_seconds)
+
+        # dns-list_records shows DreamHost's database, not what its nameservers
+        # serve, so it cannot shorten the wait; one listing afterwards still
+        # catches records DreamHost never stored
+        try:
+            missing = self._get_dreamhost_client().get_missing_txt(expected)
+        except errors.PluginError as exc:
+            logger.debug("Could not check the TXT records: %s", exc)
+            return
+
+        if missing:
+            logger.warning(
+                "TXT records not listed by DreamHost: %s",
+                ", ".join(name for name, _ in missing),
+            )
+
+    def cleanup(self, achalls: List[achallenges.AnnotatedChallenge]) -> None:
+        if self._attempt_cleanup:
+            self._run_grouped(achalls, self._cleanup)
+
+    def _run_grouped(
+        self,
+        achalls: List[achallenges.AnnotatedChallenge],
+        func: Callable[[str, str, str], None],
+    ) -> None:
+        # challenges sharing a validation name (e.g. example.com and *.example.com)
+        # touch the same record, so they run in order within one worker
+        groups = {}
+        for achall in achalls:
+            domain = _achall_domain(achall)
+            validation_name = achall.validation_domain_name(domain)
+            groups.setdefault(validation_name, []).append(
+                (domain, validation_name, achall.validation(achall.account_key))
+            )
+
+        def run_group(group):
+            for domain, validation_name, validation in group:
+                func(domain, validation_name, validation)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(groups)))) as executor:
+            futures = [executor.submit(run_group, group) for group in groups.values()]
+            for future in futures:
+                future.result()
+
     def _perform(self, domain, validation_name, validation) -> None:
         self._get_dreamhost_client().add_txt_record(
             validation_name, validation
@@ -62,70 +177,189 @@ class Authenticator(dns_common.DNSAuthenticator):
             validation_name, validation
         )
 
+    def _get_session(self) -> requests.Session:
+        if self._session is None:
+            self._session = requests.Session()
+            # one pooled HTTP/1.1 connection per worker; only failed connects are
+            # retried here, status codes are retried by _DreamHostClient
+            adapter = HTTPAdapter(
+                pool_connections=MAX_WORKERS * 2,
+                pool_maxsize=MAX_WORKERS * 2,
+                max_retries=Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.5),
+            )
+            self._session.mount("https://", adapter)
+            self._session.mount("http://", adapter)
+        return self._session
+
     def _get_dreamhost_client(self) -> "_DreamHostClient":
-        return _DreamHostClient(
-            self.credentials.conf("baseurl"),
-            self.credentials.conf("api_key"),
-        )
+        baseurl = self.credentials.conf("baseurl")
+        api_key = self.credentials.conf("api_key")
+
+        with self._cached_client_lock:
+            client = self._cached_client
+            if (client is None
+                or client.baseurl != baseurl
+                or client.api_key != api_key
+            ):
+                client = _DreamHostClient(baseurl, api_key, session=self._get_session())
+                self._cached_client = client
+            return client
 
 class _DreamHostClient():
     """
     Encapsulates all communication with the DreamHost REST API
     """
 
-    def __init__(self, baseurl, api_key):
+    def __init__(self, baseurl, api_key, session=None):
         logger.debug("creating dreamhost client")
         self.baseurl = baseurl
         self.api_key = api_key
-        self.session = requests.Session()
-        self.valid_key = self._test_key()
-
-    def _test_key(self):
-        logger.debug("testing api key")
-
-        url = f"{self._get_url('dns-list_records')}&format=json"
-        resp = self.session.get(url)
-
-        try:
-            result = resp.json()
-        except ValueError as exc:
-            logger.debug("Error parsing response json | cmd = %s | exception = %s", url, exc)
-            return False
-
-        if result["result"] == "error" and result["data"] == "invalid_api_key":
-            logger.debug("API key is invalid: %s", self.api_key)
-            return False
-
-        logger.debug("the key is valid")
-        return True
-
-    def _api_request(self, action: str):
-        if not self.valid_key:
-            return None
+        # encode the base URL and the parameters sent on every call once; any
+        # query baseurl already carries is kept
+        parts = urlsplit(baseurl)
+        default_params = dict(parse_qsl(parts.query))
+        default_params.update({"key": api_key, "format": "json"})
+        self._url_prefix = urlunsplit(
+            (parts.scheme, parts.netloc, parts.path or "/", urlencode(default_params), "")
+        ) + "&"
+        self.session = session if session is not None else requests.Session()
+        # dns-list_records returns every record on the account, so the response
+        # is kept for a short while, indexed by (record, type) to a list of
+        # records, to serve lookups that follow each other
+        self._records_index = None
+        self._records_cache_ts = 0
+        self._records_cache_ttl = 30
+        # concurrent lookups wait on the listing already in flight
+        self._list_lock = threading.Lock()
+        self._list_future = None
+        self._records_generation = 0
+        # None until the first API response tells us whether the key is valid
+        self.valid_key = None
+        # (timestamp, request, error data) of the last error reported by the API
+        self._last_error = None
+
+    def _api_request(self, action: str, params: Optional[Dict[str, str]] = None):
+        if self.valid_key is False:
+            raise errors.PluginError("The provided key is invalid")
+
+        url = self._url_prefix + urlencode({"cmd": action, **(params or {})})
+        request = (action, tuple(sorted((params or {}).items())))
+        if (self._last_error is not None
+            and self._last_error[1] == request
+            and time.time() - self._last_error[0] < NEGATIVE_CACHE_SECONDS
+        ):
+            logger.debug("Replaying cached API error | cmd = %s", action)
+            raise errors.PluginError(
+                f"API response with an error: {self._last_error[2]}"
+            )
 
-        url = f"{self._get_url(action)}&format=json"
-        resp = self.session.get(url)
-        logger.debug("API Request | cmd = %s", url)
+        attempts = LIST_ATTEMPTS if action == "dns-list_records" else WRITE_ATTEMPTS
+        resp = self._get_with_retries(url, attempts)
+        logger.debug("API Request | cmd = %s | params = %s", action, params)
         if resp.status_code != 200:
-            raise Exception(
-                f"HTTP Error during login {resp.status_code}"
+            raise errors.PluginError(
+                f"HTTP Error during API request {resp.status_code}"
             )
         try:
-            result = resp.json()
+            result = _loads(resp.content)
         except Exception as exp:
-            raise Exception(
-                f"API response with non JSON: {resp.text} from exp"
+            raise errors.PluginError(
+                f"API response with non JSON: {resp.text}"
             ) from exp
 
+        if result["result"] == "error" and result["data"] == "invalid_api_key":
+            logger.debug("API key is invalid: %s", self.api_key)
+            self.valid_key = False
+            raise errors.PluginError("The provided key is invalid")
+
+        self.valid_key = True
         if result["result"] == "success":
+            self._last_error = None
             return result["data"]
 
+        self._last_error = (time.time(), request, result["data"])
         raise errors.PluginError(
             f"API response with an error: {result['data']}"
         )
 
-    def _get_url(self, action:str):
-        return f"{self.baseurl}?key={self.api_key}&cmd={action}"
+    def _get_with_retries(self, url: str, attempts: int) -> requests.Response:
+        for attempt in range(attempts):
+            try:
+                resp = self.session.get(url, timeout=REQUEST_TIMEOUT_SECONDS)
+            except requests.exceptions.RequestException as exc:
+                raise errors.PluginError(
+                    f"Error communicating with the DreamHost API: {exc}"
+                ) from exc
+            if resp.status_code not in RETRY_STATUSES or attempt == attempts - 1:
+                break
+
+            delay = min(RETRY_CAP_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt)
+            delay += random.uniform(0, RETRY_BASE_SECONDS)
+            retry_after = resp.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = max(delay, min(RETRY_CAP_SECONDS, int(retry_after)))
+
+            logger.debug(
+                "HTTP %s from DreamHost API, retrying in %.1f seconds",
+                resp.status_code, delay,
+            )
+            time.sleep(delay)
+
+        return resp
+
+    def _list_records(self, force:bool = False) -> Dict[tuple, List[dict]]:
+        with self._list_lock:
+            if (not force
+                and self._records_index is not None
+                and time.time() - self._records_cache_ts < self._records_cache_ttl
+            ):
+                logger.debug("Using cached dns-list_records response")
+                return self._records_index
+
+            owner = self._list_future is None
+            if owner:
+                self._list_future = Future()
+                generation = self._records_generation
+            future = self._list_future
+
+        if not owner:
+            logger.debug("Waiting for dns-list_records already in flight")
+            return future.result()
+
+        # the slot must be cleared and the waiters resolved whatever happens,
+        # including KeyboardInterrupt, or they would hang on future.result()
+        index = None
+        try:
+            records = self._api_request("dns-list_records")
+            # only TXT records are ever looked up, so the rest of the listing,
+            # usually the bulk of a large account, is released right away.
+            # A name can hold several TXT values at once (e.g. example.com and
+            # *.example.com share _acme-challenge.example.com), so keep them all
+            index = {}
+            for record in records or []:
+                if record.get("type") == "TXT":
+                    index.setdefault((record["record"], "TXT"), []).append(record)
+            del records
+        except BaseException as exc:
+            index = None
+            future.set_exception(exc)
+            raise
+        finally:
+            with self._list_lock:
+                self._list_future = None
+                # a record written while listing makes this response stale
+                if index is not None and generation == self._records_generation:
+                    self._records_index = index
+                    self._records_cache_ts = time.time()
+
+        future.set_result(index)
+        return index
+
+    def _invalidate_records_cache(self):
+        with self._list_lock:
+            self._records_index = None
+            self._records_cache_ts = 0
+            self._records_generation += 1
 
     def add_txt_record(self, record_name:str, record_content:str) -> None:
         """
@@ -133,26 +367,24 @@ class _DreamHostClient():
 
         :param str record_name: The record name
         :param str record_content: The record content
-        :raises exception if an error occurs communicating with the DreamHost API
+        :raises errors.PluginError if an error occurs communicating with the DreamHost API
         """
 
-        if not self.valid_key:
-            raise Exception("The provided key is invalid")
+        if self.valid_key is False:
+            raise errors.PluginError("The provided key is invalid")
 
-        record = self.get_existing_txt(record_name)
-        if record is not None:
-            if record["value"] == record_content:
-                logger.info("This record already exists. name = %s", record_name)
-                return
-
-            logger.info("Updating record %s", record_name)
-            # we have to delete the record in order to add a new one with different content
-            # DreamHost does not provide any update method (09-11-2022)
-            # https://help.dreamhost.com/hc/en-us/articles/217555707-DNS-API-commands
-            self.delete_txt_record(record_name, record_content)
+        # other TXT values under the same name are left alone: they may belong
+        # to another challenge of this run (e.g. example.com and *.example.com)
+        if self.get_existing_txt(record_name, record_content) is not None:
+            logger.info("This record already exists. name = %s", record_name)
+            return
 
         logger.info("Creating a new TXT record")
-        self._api_request(f"dns-add_record&record={record_name}&type=TXT&value={record_content}")
+        self._api_request(
+            "dns-add_record",
+            {"record": record_name, "type": "TXT", "value": record_content},
+        )
+        self._invalidate_records_cache()
 
     def delete_txt_record(self, record_name:str, record_content:str):
         """
@@ -160,39 +392,54 @@ class _DreamHostClient():
 
         :param str record_name: The record name
         :param str record_content: The record content
-        :raises exception if an error occurs communicating with the DreamHost API
+        :raises errors.PluginError if an error occurs communicating with the DreamHost API
         """
 
-        if not self.valid_key:
-            raise Exception("The provided key is invalid")
+        if self.valid_key is False:
+            raise errors.PluginError("The provided key is invalid")
 
-        record = self.get_existing_txt(record_name)
-        if record is not None:
-            if record["value"] == record_content:
-                logger.info("Creating a new TXT record. name = %s", record_name)
-                self._api_request(
-                    f"dns-remove_record&record={record_name}&type=TXT&value={record_content}"
-                )
+        if self.get_existing_txt(record_name, record_content) is not None:
+            logger.info("Deleting TXT record. name = %s", record_name)
+            self._api_request(
+                "dns-remove_record",
+                {"record": record_name, "type": "TXT", "value": record_content},
+            )
+            self._invalidate_records_cache()
 
-    def get_existing_txt(self, record_name:str) -> str:
+    def get_existing_txt(self, record_name:str, record_content:str) -> Optional[dict]:
         """
         Searches for an already existing TXT record that contains
         the same content that we want to store.
 
         :param str record_name: the record name
+        :param str record_content: the record content
 
-        :returns: TXT record value or None
-        :rtype: 'string' or 'None'
+        :returns: TXT record or None
+        :rtype: 'dict' or 'None'
         """
 
-        if not self.valid_key:
+        if self.valid_key is False:
             return None
 
-        records = self._api_request("dns-list_records")
-        for record in records:
-            if (record["record"] == record_name
-                and record["type"] == "TXT"
-            ):
+        for record in self._list_records().get((record_name, "TXT"), []):
+            if record["value"] == record_content:
                 return record
 
         return None
+
+    def get_missing_txt(self, records: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """
+        Checks a fresh listing for TXT records
+
+        :param list records: (record name, record content) pairs
+        :returns: the pairs DreamHost does not list
+        :rtype: 'list'
+        """
+
+        index = self._list_records(force=True)
+        return [
+            (name, content) for name, content in records
+            if not any(
+                record["value"] == content for record in index.get((name, "TXT"), [])
+            )
+        ]
@@ -0,0 +1,296 @@
+"""Tests for certbot_dns_dreamhost.dns_dreamhost."""
+
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+
+from certbot_dns_dreamhost import dns_dreamhost
+
+
+class FakeResponse:
+    """A requests.Response carrying a DreamHost API envelope"""
+
+    def __init__(self, data, status_code=200):
+        self.status_code = status_code
+        self.content = json.dumps(data).encode()
+        self.text = self.content.decode()
+        self.headers = {}
+
+
+class FakeSession:
+    """Answers DreamHost API calls from an in-memory list of records"""
+
+    def __init__(self, records=None):
+        self.records = list(records or [])
+        self.calls = []
+        self.lock = threading.Lock()
+        # when set, dns-list_records blocks until this event is set
+        self.list_gate = None
+        self.list_started = threading.Event()
+
+    def get(self, url, timeout=None):
+        params = dict(parse_qsl(urlsplit(url).query))
+        cmd = params["cmd"]
+        with self.lock:
+            self.calls.append(cmd)
+
+        if cmd == "dns-list_records":
+            snapshot = [dict(record) for record in self.records]
+            self.list_started.set()
+            if self.list_gate is not None:
+                self.list_gate.wait(5)
+            return FakeResponse({"result": "success", "data": snapshot})
+
+        record = {"record": params["record"], "type": params["type"], "value": params["value"]}
+        if cmd == "dns-add_record":
+            self.records.append(record)
+        elif cmd == "dns-remove_record":
+            self.records.remove(record)
+        return FakeResponse({"result": "success", "data": "record_added"})
+
+
+def txt(name, value):
+    return {"record": name, "type": "TXT", "value": value}
+
+
+class DreamHostClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.session = FakeSession()
+        self.client = dns_dreamhost._DreamHostClient(
+            "https://api.dreamhost.com/", "key", session=self.session
+        )
+
+    def test_add_keeps_other_values_for_the_same_name(self):
+        self.client.add_txt_record("_acme-challenge.example.com", "v1")
+        self.client.add_txt_record("_acme-challenge.example.com", "v2")
+
+        self.assertEqual(
+            [txt("_acme-challenge.example.com", "v1"), txt("_acme-challenge.example.com", "v2")],
+            self.session.records,
+        )
+        self.assertNotIn("dns-remove_record", self.session.calls)
+
+    def test_add_skips_existing_value(self):
+        self.session.records = [txt("_acme-challenge.example.com", "v1")]
+
+        self.client.add_txt_record("_acme-challenge.example.com", "v1")
+
+        self.assertEqual(["dns-list_records"], self.session.calls)
+
+    def test_delete_removes_only_the_matching_value(self):
+        self.session.records = [
+            txt("_acme-challenge.example.com", "v1"),
+            txt("_acme-challenge.example.com", "v2"),
+        ]
+
+        self.client.delete_txt_record("_acme-challenge.example.com", "v2")
+        self.client.delete_txt_record("_acme-challenge.example.com", "v1")
+
+        self.assertEqual([], self.session.records)
+
+    def test_retry_after_is_capped(self):
+        throttled = FakeResponse({}, status_code=429)
+        throttled.headers["Retry-After"] = "3600"
+        self.session.get = mock.Mock(
+            side_effect=[throttled, FakeResponse({"result": "success", "data": []})]
+        )
+
+        clock = FakeClock()
+        with mock.patch.object(dns_dreamhost, "time", clock):
+            self.client.get_existing_txt("_acme-challenge.example.com", "v1")
+
+        self.assertLessEqual(clock.slept, dns_dreamhost.RETRY_CAP_SECONDS)
+        self.assertGreater(clock.slept, 0)
+        self.assertEqual(
+            dns_dreamhost.REQUEST_TIMEOUT_SECONDS, self.session.get.call_args.kwargs["timeout"]
+        )
+
+    def test_network_errors_raise_plugin_error(self):
+        self.session.get = mock.Mock(side_effect=requests.exceptions.ReadTimeout("timed out"))
+
+        with self.assertRaises(dns_dreamhost.errors.PluginError):
+            self.client.add_txt_record("_acme-challenge.example.com", "v1")
+
+    def _start_blocked_listing(self):
+        self.session.list_gate = threading.Event()
+        owner = threading.Thread(target=self.client._list_records)
+        owner.start()
+        self.assertTrue(self.session.list_started.wait(5))
+        return owner
+
+    def test_concurrent_lookups_share_one_listing(self):
+        self.session.records = [txt("_acme-challenge.example.com", "v1")]
+        owner = self._start_blocked_listing()
+        results = []
+        waiters = [
+            threading.Thread(
+                target=lambda: results.append(
+                    self.client.get_existing_txt("_acme-challenge.example.com", "v1")
+                )
+            )
+            for _ in range(4)
+        ]
+        for waiter in waiters:
+            waiter.start()
+        # give the waiters time to find the listing in flight
+        time.sleep(0.2)
+        self.session.list_gate.set()
+        for thread in [owner] + waiters:
+            thread.join(5)
+
+        self.assertEqual(["dns-list_records"], self.session.calls)
+        self.assertEqual([txt("_acme-challenge.example.com", "v1")] * 4, results)
+
+    def test_listing_overlapping_a_write_is_not_cached(self):
+        owner = self._start_blocked_listing()
+        self.client._invalidate_records_cache()
+        self.session.list_gate.set()
+        owner.join(5)
+
+        self.assertIsNone(self.client._records_index)
+        self.session.list_gate = None
+        self.client.get_existing_txt("_acme-challenge.example.com", "v1")
+        self.assertEqual(["dns-list_records", "dns-list_records"], self.session.calls)
+
+    def test_interrupted_listing_releases_waiters(self):
+        gate = threading.Event()
+        started = threading.Event()
+
+        def interrupted_get(url, timeout=None):
+            started.set()
+            gate.wait(5)
+            raise KeyboardInterrupt
+
+        get = self.session.get
+        self.session.get = interrupted_get
+        raised = []
+
+        def lookup():
+            try:
+                self.client._list_records()
+            except KeyboardInterrupt:
+                raised.append(threading.current_thread())
+
+        owner = threading.Thread(target=lookup)
+        owner.start()
+        self.assertTrue(started.wait(5))
+        waiter = threading.Thread(target=lookup)
+        waiter.start()
+        time.sleep(0.2)
+        gate.set()
+        owner.join(5)
+        waiter.join(5)
+
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(2, len(raised))
+        self.assertIsNone(self.client._list_future)
+        self.session.get = get
+        self.assertEqual({}, self.client._list_records())
+
+
+class FakeClock:
+    """Replaces time.time and time.sleep so waits take no real time"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept += seconds
+        self.now += seconds
+
+
+def achall(domain, validation):
+    # only identifier is set: reading the deprecated domain attribute fails
+    challenge = mock.MagicMock(spec=["identifier", "validation_domain_name", "validation",
+                                     "response", "account_key"])
+    challenge.identifier.value = domain
+    challenge.validation_domain_name.return_value = f"_acme-challenge.{domain.lstrip('*.')}"
+    challenge.validation.return_value = validation
+    return challenge
+
+
+class AuthenticatorTest(unittest.TestCase):
+
+    def setUp(self):
+        config = mock.MagicMock(dns_dreamhost_propagation_seconds=120)
+        self.auth = dns_dreamhost.Authenticator(config, "dns-dreamhost")
+        self.auth.credentials = mock.MagicMock()
+        self.auth.credentials.conf.side_effect = {
+            "baseurl": "https://api.dreamhost.com/", "api_key": "key"
+        }.get
+        self.auth._setup_credentials = mock.MagicMock()
+        self.session = FakeSession()
+        self.auth._session = self.session
+
+        patcher = mock.patch("certbot_dns_dreamhost.dns_dreamhost.display_util")
+        self.display_util = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # replaces the module's time name only, the real time module is untouched
+        self.clock = FakeClock()
+        patcher = mock.patch.object(dns_dreamhost, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_apex_and_wildcard_values_coexist(self):
+        achalls = [achall("example.com", "v1"), achall("*.example.com", "v2")]
+
+        self.auth.perform(achalls)
+        self.assertEqual(
+            [txt("_acme-challenge.example.com", "v1"), txt("_acme-challenge.example.com", "v2")],
+            self.session.records,
+        )
+
+        self.auth.cleanup(achalls)
+        self.assertEqual([], self.session.records)
+
+    def test_domain_falls_back_for_older_certbot(self):
+        challenge = mock.MagicMock(spec=["domain"])
+        challenge.domain = "example.com"
+
+        self.assertEqual("example.com", dns_dreamhost._achall_domain(challenge))
+
+    def test_propagation_time_is_waited_in_full(self):
+        self.auth.perform([achall("example.com", "v1")])
+
+        self.assertEqual(120, self.clock.slept)
+        self.display_util.notify.assert_called_once_with(
+            "Waiting 120 seconds for DNS changes to propagate"
+        )
+
+    def test_records_are_checked_once_after_the_wait(self):
+        achalls = [achall(f"host{i}.example.com", f"v{i}") for i in range(6)]
+        self.auth._get_dreamhost_client().add_txt_record = mock.MagicMock()
+
+        with self.assertLogs(dns_dreamhost.logger, "WARNING") as logs:
+            self.auth.perform(achalls)
+
+        self.assertEqual(["dns-list_records"], self.session.calls)
+        self.assertEqual(120, self.clock.slept)
+        self.assertIn("_acme-challenge.host5.example.com", logs.output[0])
+
+    def test_listed_records_are_not_reported(self):
+        with self.assertNoLogs(dns_dreamhost.logger, "WARNING"):
+            self.auth.perform([achall("example.com", "v1")])
+
+    def test_check_errors_do_not_fail_perform(self):
+        client = self.auth._get_dreamhost_client()
+        client.get_missing_txt = mock.MagicMock(side_effect=dns_dreamhost.errors.PluginError("boom"))
+
+        self.auth.perform([achall("example.com", "v1")])
+
+        self.assertEqual(120, self.clock.slept)
+
+
+if __name__ == "__main__":
+    unittest.main()